@@ -35,12 +35,7 @@ def example_load_and_display_results():
 def example_find_results_by_keyword(keyword: str):
     """Find all results containing a specific keyword in the prompt."""
     storage = StorageService()
-    results = storage.get_all_results()
-
-    matching = [
-        r for r in results 
-        if keyword.lower() in r['user_prompt'].lower()
-    ]
+    matching = storage.find_results_by_keyword(keyword)
 
     print(f"Found {len(matching)} results matching '{keyword}':\n")
 
@@ -72,18 +67,28 @@ def example_export_summary():
 
     output_file = storage.output_dir / "summary.txt"
 
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(f"AutoEdit Results Summary\n")
-        f.write(f"Total Results: {len(results)}\n")
-        f.write("=" * 80 + "\n\n")
+    with open(output_file, "w", encoding="utf-8", buffering=1 << 20) as f:
+        f.write(
+            "AutoEdit Results Summary\n"
+            f"Total Results: {len(results)}\n"
+            + "=" * 80 + "\n\n"
+        )
 
+        # One string per record, flushed to the file in batches
+        chunk = []
         for i, result in enumerate(results, 1):
-            f.write(f"[{i}] {result['id']}\n")
-            f.write(f"Timestamp: {result['timestamp']}\n")
-            f.write(f"Prompt: {result['user_prompt']}\n")
-            f.write(f"Caption: {result['caption'][:200]}\n")
-            f.write(f"Image: {result.get('image_filename', 'None')}\n")
-            f.write("\n")
+            chunk.append(
+                f"[{i}] {result['id']}\n"
+                f"Timestamp: {result['timestamp']}\n"
+                f"Prompt: {result['user_prompt']}\n"
+                f"Caption: {result['caption'][:200]}\n"
+                f"Image: {result.get('image_filename', 'None')}\n"
+                "\n"
+            )
+            if len(chunk) >= 1000:
+                f.writelines(chunk)
+                chunk.clear()
+        f.writelines(chunk)
 
     print(f"Summary exported to: {output_file}")
 
@@ -10,6 +10,47 @@ from __future__ import annotations
 import json
 from pathlib import Path
 from datetime import datetime
+from typing import Iterator, Optional
+
+from autoedit.services.jsonl import iter_records_reversed, read_record
+
+
+def _iter_results(output_dir: Path) -> Optional[Iterator[dict]]:
+    """Yield stored results newest first, or return None if there are none.
+
+    Output directories written by older versions hold a ``results.json``
+    array that StorageService migrates on first use; it is read directly
+    until then.
+    """
+    results_file = output_dir / "results.jsonl"
+    if results_file.exists():
+        return iter_records_reversed(results_file)
+
+    legacy_file = output_dir / "results.json"
+    if legacy_file.exists():
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
+                return iter(json.load(f))
+        except (json.JSONDecodeError, OSError):
+            return None
+    return None
+
+
+def _lookup_indexed(output_dir: Path, result_id: str) -> Optional[dict]:
+    """Read a single entry via ``results.index.jsonl`` instead of scanning."""
+    results_file = output_dir / "results.jsonl"
+    try:
+        results_size = results_file.stat().st_size
+        for entry in iter_records_reversed(output_dir / "results.index.jsonl"):
+            if entry["id"] != result_id:
+                continue
+            if entry["offset"] + entry["length"] >= results_size:
+                return None
+            result = read_record(results_file, entry["offset"], entry["length"])
+            return result if result.get("id") == result_id else None
+    except (ValueError, KeyError, OSError):
+        return None
+    return None
 
 
 def view_results(output_dir: Path = None) -> None:
@@ -23,24 +64,19 @@ def view_results(output_dir: Path = None) -> None:
     if output_dir is None:
         output_dir = Path(__file__).parent.parent / "output"
 
-    results_file = output_dir / "results.json"
+    results_file = output_dir / "results.jsonl"
+    results = _iter_results(output_dir)
 
-    if not results_file.exists():
-        print("No results found. The results.json file doesn't exist yet.")
+    if results is None:
+        print("No results found. The results.jsonl file doesn't exist yet.")
         print(f"Expected location: {results_file}")
         return
 
-    with open(results_file, "r", encoding="utf-8") as f:
-        results = json.load(f)
-
-    if not results:
-        print("No results stored yet.")
-        return
-
-    print(f"Found {len(results)} result(s):\n")
-    print("=" * 80)
-
+    count = 0
     for i, result in enumerate(results, 1):
+        if i == 1:
+            print("=" * 80)
+        count = i
         timestamp = datetime.fromisoformat(result["timestamp"])
         print(f"\n[{i}] {result['id']}")
         print(f"    Timestamp: {timestamp.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -60,7 +96,12 @@ def view_results(output_dir: Path = None) -> None:
             status_summary = ", ".join(step_statuses)
             print(f"    Steps: {status_summary}")
 
+    if not count:
+        print("No results stored yet.")
+        return
+
     print("\n" + "=" * 80)
+    print(f"\nFound {count} result(s).")
     print(f"\nResults file: {results_file}")
     print(f"Images directory: {output_dir / 'images'}")
 
@@ -78,16 +119,15 @@ def view_result_detail(result_id: str, output_dir: Path = None) -> None:
     if output_dir is None:
         output_dir = Path(__file__).parent.parent / "output"
 
-    results_file = output_dir / "results.json"
+    results = _iter_results(output_dir)
 
-    if not results_file.exists():
+    if results is None:
         print("No results found.")
         return
 
-    with open(results_file, "r", encoding="utf-8") as f:
-        results = json.load(f)
-
-    result = next((r for r in results if r["id"] == result_id), None)
+    result = _lookup_indexed(output_dir, result_id)
+    if result is None:
+        result = next((r for r in results if r["id"] == result_id), None)
 
     if not result:
         print(f"Result with ID '{result_id}' not found.")
@@ -8,14 +8,47 @@ modification.
 
 from __future__ import annotations
 
-from typing import List, Optional
+import os
+
+# Must be set before torch initializes CUDA. Expandable segments let the
+# caching allocator grow in place instead of fragmenting across edits.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+# Optional cap on the VRAM this process may allocate, as a fraction of the
+# device (e.g. "0.9"), for sharing the GPU with other processes. It limits
+# both models, and cuBLAS/cuDNN workspaces count against it too.
+CUDA_MEMORY_FRACTION = os.environ.get("AUTOEDIT_CUDA_MEMORY_FRACTION")
+
+import dataclasses
+import io
+import time
+from collections import deque
+from itertools import islice
+from typing import Deque, List, Optional
 
 import streamlit as st
+from PIL import Image
 
 from autoedit.services.image_processor import ImageProcessor, ProcessResult
 from autoedit.ui import layout
 
 
+_WORKFLOW_STEPS = (
+    "Loading JoyCaption into VRAM",
+    "Extracting Edit Instructions",
+    "Loading QWEN-Image-Edit into VRAM",
+    "Applying QWEN-Image-Edit",
+)
+
+# Minimum delay between re-renders of the same step and status; status
+# transitions always render.
+_PROGRESS_RENDER_INTERVAL = 0.1
+
+# History only feeds the sidebar thumbnails, so it keeps downscaled copies.
+_HISTORY_LENGTH = 6
+_HISTORY_THUMBNAIL_SIZE = (256, 256)
+
+
 def run() -> None:
     """Configure the Streamlit page and render the full experience."""
     st.set_page_config(
@@ -47,10 +80,8 @@ def run() -> None:
         if latest_result:
             layout.render_output_panel(latest_result)
 
-    sidebar_history: List[ProcessResult] = (
-        st.session_state.get("edit_history", [])[1:]
-        if st.session_state.get("edit_history")
-        else []
+    sidebar_history: List[ProcessResult] = list(
+        islice(st.session_state.get("edit_history", ()), 1, None)
     )
     layout.render_history_sidebar(sidebar_history)
 
@@ -58,6 +89,21 @@ def run() -> None:
 
 
 
+@st.cache_resource
+def _get_processor() -> ImageProcessor:
+    """Return the processor shared across Streamlit reruns and sessions.
+
+    Set ``AUTOEDIT_WARMUP=1`` to load and warm up both models when the
+    processor is first created instead of on the first edit. Set
+    ``AUTOEDIT_CUDA_MEMORY_FRACTION`` to cap the process's VRAM.
+    """
+    if CUDA_MEMORY_FRACTION:
+        import torch
+
+        torch.cuda.set_per_process_memory_fraction(float(CUDA_MEMORY_FRACTION))
+    return ImageProcessor(warmup_models=os.environ.get("AUTOEDIT_WARMUP") == "1")
+
+
 def _process_image(prompt: str, image_data: Optional[bytes]) -> Optional[ProcessResult]:
     """Execute the staged editing workflow and manage UI side effects.
 
@@ -73,15 +119,10 @@ def _process_image(prompt: str, image_data: Optional[bytes]) -> Optional[Process
         st.info("Please upload an image to begin processing.")
         return None
 
-    steps = [
-        "Loading JoyCaption into VRAM",
-        "Extracting Edit Instructions",
-        "Loading QWEN-Image-Edit into VRAM",
-        "Applying QWEN-Image-Edit",
-    ]
+    steps = _WORKFLOW_STEPS
     statuses = ["pending"] * len(steps)
     progress_placeholder = st.empty()
-    current_step = {"index": 0}
+    current_step = {"index": 0, "last_render": 0.0, "last_state": None}
 
     layout.render_workflow_progress(
         placeholder=progress_placeholder,
@@ -92,17 +133,19 @@ def _process_image(prompt: str, image_data: Optional[bytes]) -> Optional[Process
 
     def update_progress(step_index: int, status: str, message: str) -> None:
         current_step["index"] = step_index
-        if status == "active":
-            statuses[step_index] = "active"
-            for idx in range(step_index):
-                if statuses[idx] != "complete":
-                    statuses[idx] = "complete"
-        elif status == "complete":
-            statuses[step_index] = "complete"
-            if step_index + 1 < len(statuses) and statuses[step_index + 1] == "pending":
-                statuses[step_index + 1] = "active"
-        elif status == "error":
-            statuses[step_index] = "error"
+        _advance_statuses(statuses, step_index, status)
+
+        # Every step/status transition is shown; only repeated updates for
+        # the same state are rate limited.
+        now = time.perf_counter()
+        state = (step_index, status)
+        if (
+            state == current_step["last_state"]
+            and now - current_step["last_render"] < _PROGRESS_RENDER_INTERVAL
+        ):
+            return
+        current_step["last_render"] = now
+        current_step["last_state"] = state
 
         layout.render_workflow_progress(
             placeholder=progress_placeholder,
@@ -111,7 +154,7 @@ def _process_image(prompt: str, image_data: Optional[bytes]) -> Optional[Process
             detail_text=message,
         )
 
-    processor = ImageProcessor()
+    processor = _get_processor()
 
     try:
         result = processor.process(
@@ -128,10 +171,12 @@ def _process_image(prompt: str, image_data: Optional[bytes]) -> Optional[Process
         st.warning("The editing pipeline completed without returning an image.")
         return None
 
-    history: List[ProcessResult] = st.session_state.setdefault("edit_history", [])
-    history.insert(0, result)
-    if len(history) > 6:
-        del history[6:]
+    history: Deque[ProcessResult] = st.session_state.setdefault(
+        "edit_history", deque(maxlen=_HISTORY_LENGTH)
+    )
+    history.appendleft(
+        dataclasses.replace(result, final_image=_make_thumbnail(result.final_image))
+    )
 
     layout.render_workflow_progress(
         placeholder=progress_placeholder,
@@ -143,6 +188,31 @@ def _process_image(prompt: str, image_data: Optional[bytes]) -> Optional[Process
     return result
 
 
+def _make_thumbnail(image_bytes: bytes) -> bytes:
+    """Return a small JPEG preview of ``image_bytes`` for the history panel."""
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.thumbnail(_HISTORY_THUMBNAIL_SIZE)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=85)
+    except (OSError, ValueError):
+        return image_bytes
+    return buffer.getvalue()
+
+
+def _advance_statuses(statuses: List[str], step_index: int, status: str) -> None:
+    """Update ``statuses`` in place for a progress event on ``step_index``."""
+    if status == "active":
+        statuses[step_index] = "active"
+        statuses[:step_index] = ["complete"] * step_index
+    elif status == "complete":
+        statuses[step_index] = "complete"
+        if step_index + 1 < len(statuses) and statuses[step_index + 1] == "pending":
+            statuses[step_index + 1] = "active"
+    elif status == "error":
+        statuses[step_index] = "error"
+
+
 def _prepare_refine_state() -> None:
     """Apply any pending refine request before widgets are instantiated."""
 
@@ -0,0 +1,92 @@
+"""Persistent cache of JoyCaption outputs.
+
+With greedy decoding, the same upload and user prompt produce the same
+caption as long as the caption settings (prompt template, model,
+quantization, decoding limits) are unchanged. Those settings are hashed into
+a version tag that is part of every key, so changing any of them misses the
+cache instead of returning stale captions. Iterating on an edit in the UI
+re-submits both unchanged, and this cache lets those runs skip the caption
+model entirely. Entries are appended to a JSON Lines file and survive
+restarts.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from services.jsonl import append_record, iter_records
+
+try:  # pragma: no cover - optional SIMD-accelerated hash
+    from blake3 import blake3
+except ModuleNotFoundError:  # pragma: no cover - falls back to hashlib
+    blake3 = None  # type: ignore[assignment]
+
+
+def caption_key(image_bytes: bytes, prompt: str, version: str = "") -> str:
+    """Return the content hash identifying an ``(image, prompt)`` pair.
+
+    ``version`` tags the caption settings the pair was captioned with.
+    """
+    hasher = blake3() if blake3 is not None else hashlib.blake2b(digest_size=32)
+    hasher.update(version.encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(image_bytes)
+    hasher.update(b"\0")
+    hasher.update(prompt.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class CaptionCache:
+    """Maps ``(image, prompt)`` pairs to previously generated captions."""
+
+    def __init__(self, cache_file: Path, version: str = "") -> None:
+        """Initialize the cache.
+
+        Parameters
+        ----------
+        cache_file:
+            The JSON Lines file backing the cache. It is read on first use
+            and created, along with its directory, on the first write.
+        version:
+            Tag of the caption settings in use (see
+            ``caption_service.caption_cache_version``). Entries written under
+            another tag are never returned.
+        """
+        self.cache_file = cache_file
+        self.version = version
+        self._captions: Optional[Dict[str, str]] = None
+        self._lock = threading.Lock()
+
+    def get(self, image_bytes: bytes, prompt: str) -> Optional[str]:
+        """Return the cached caption for the pair, or None if there is none."""
+        key = caption_key(image_bytes, prompt, self.version)
+        with self._lock:
+            return self._load().get(key)
+
+    def put(self, image_bytes: bytes, prompt: str, caption: str) -> None:
+        """Remember ``caption`` for the pair."""
+        key = caption_key(image_bytes, prompt, self.version)
+        with self._lock:
+            captions = self._load()
+            if captions.get(key) == caption:
+                return
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            append_record(self.cache_file, {"key": key, "caption": caption})
+            captions[key] = caption
+
+    def _load(self) -> Dict[str, str]:
+        if self._captions is None:
+            captions: Dict[str, str] = {}
+            if self.cache_file.exists():
+                # Later lines win, so re-captioned pairs keep their newest caption
+                for _, _, record in iter_records(self.cache_file):
+                    captions[record["key"]] = record["caption"]
+            # Only assigned once fully read, so a failed read is retried
+            self._captions = captions
+        return self._captions
+
+
+__all__ = ["CaptionCache", "caption_key"]
@@ -2,76 +2,394 @@
 
 from __future__ import annotations
 
+import functools
+import hashlib
+import importlib.util
 import io
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from PIL import Image
 
-from typing import Optional
-
-try:  # pragma: no cover - optional heavy dependency path
-    import torch
-    from transformers import AutoProcessor, LlavaForConditionalGeneration
-except ModuleNotFoundError:  # pragma: no cover - handled gracefully
-    torch = None  # type: ignore[assignment]
-    AutoProcessor = None  # type: ignore[assignment]
-    LlavaForConditionalGeneration = None  # type: ignore[assignment]
+from typing import List, Optional, Tuple
 
 from autoedit.services.prompts import JOYCAPTION_PROMPT
 
 
 MODEL_NAME = "fancyfeast/llama-joycaption-beta-one-hf-llava"
 
-def generate_caption(image_bytes: bytes, prompt: str, progress_callback) -> str:
+# torch and transformers are imported where they are used so that importing
+# this module (e.g. from the storage CLI scripts) stays cheap.
+# Optional backends are probed without importing them.
+HAS_BITSANDBYTES = importlib.util.find_spec("bitsandbytes") is not None
 
-    if progress_callback:
-        progress_callback(0, "active", "Loading JoyCaption model...")
+# Weight quantization of the language model: "nf4" (default), "int8", or
+# "none" for bf16. Decode is bandwidth bound, so fewer weight bytes speed up
+# every token; int8 trades some of that speed for closer-to-bf16 output.
+# Quantization needs bitsandbytes and is skipped without it.
+QUANTIZATION = os.environ.get("AUTOEDIT_CAPTION_QUANTIZATION", "nf4").lower()
+
+# Fused attention kernels; flash-attn is optional, SDPA ships with PyTorch.
+ATTN_IMPLEMENTATION = (
+    "flash_attention_2" if importlib.util.find_spec("flash_attn") is not None else "sdpa"
+)
+
+# Smallest size JPEG draft decoding may shrink uploads to before captioning.
+CAPTION_DECODE_SIZE = (768, 768)
+
+# Concurrent caption requests (e.g. from several Streamlit sessions) arriving
+# within this window are decoded together in one batched generate call.
+CAPTION_BATCH_WINDOW = 0.03
+CAPTION_MAX_BATCH = 4
+
+# Edit plans are a single line of 1-4 short edits (well under 60 tokens), so
+# generation stops at the first newline and is capped a little above that.
+CAPTION_MAX_NEW_TOKENS = 96
+CAPTION_STOP_STRINGS = ["\n"]
+
+# Edit plans must match this pattern: one to four comma-separated edits on a
+# single line. With outlines installed, decoding is constrained to it through
+# a precompiled token-level automaton, so the model cannot drift into
+# preambles or explanations. The pattern ends in the newline that
+# CAPTION_STOP_STRINGS stops on, so the model can close the line itself
+# rather than running on to the token cap. Set to None to decode freely.
+CAPTION_OUTPUT_PATTERN: Optional[str] = r"[A-Za-z0-9][^,\n]*(, [^,\n]+){0,3}\n"
+HAS_OUTLINES = importlib.util.find_spec("outlines") is not None
+
+_SAMPLING_KWARGS = {
+    "greedy": {"do_sample": False, "num_beams": 1},
+    "sample": {"do_sample": True, "temperature": 0.6, "top_p": 0.9},
+}
+
+# Decoding of edit plans, from AUTOEDIT_CAPTION_SAMPLING: "greedy" (default)
+# skips per-step sampling and makes edit plans reproducible, so they can be
+# cached; "sample" gives more varied phrasings.
+SAMPLING_MODE = os.environ.get("AUTOEDIT_CAPTION_SAMPLING", "greedy").lower()
+if SAMPLING_MODE not in _SAMPLING_KWARGS:
+    raise ValueError(
+        f"AUTOEDIT_CAPTION_SAMPLING must be one of {sorted(_SAMPLING_KWARGS)}, "
+        f"got {SAMPLING_MODE!r}"
+    )
+
+_MODEL_LOCK = threading.Lock()
+
+# Projected vision features of recently captioned images, keyed by a hash of
+# the upload bytes, so re-captioning an image with another prompt only runs
+# the language model. Only the caption worker thread touches this.
+IMAGE_FEATURE_CACHE_SIZE = 16
+_IMAGE_FEATURES: "OrderedDict[str, object]" = OrderedDict()
+
+_CAPTION_REQUESTS: "queue.Queue[Tuple[Image.Image, str, Optional[str], Future]]" = queue.Queue()
+_WORKER_LOCK = threading.Lock()
+_worker: Optional[threading.Thread] = None
+
+
+@functools.lru_cache(maxsize=1)
+def _load_model(model_name: str):
+    import torch
+    from transformers import AutoProcessor, BitsAndBytesConfig, LlavaForConditionalGeneration
+
+    # The fast (torchvision) image processor can resize and normalize on GPU
+    processor = AutoProcessor.from_pretrained(model_name, use_fast=True)
+    # Batched prompts are padded on the left so generation continues from
+    # the last real token of every row.
+    processor.tokenizer.padding_side = "left"
 
-    processor = AutoProcessor.from_pretrained(MODEL_NAME)
-        
     dtype = torch.bfloat16
+
+    # The vision tower and projector stay in bf16 to keep image features
+    # intact; accelerate may keep overflow layers on the CPU.
+    quantization_config = None
+    if HAS_BITSANDBYTES and QUANTIZATION == "nf4":
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=dtype,
+            bnb_4bit_use_double_quant=True,
+            llm_int8_skip_modules=["vision_tower", "multi_modal_projector"],
+            llm_int8_enable_fp32_cpu_offload=True,
+        )
+    elif HAS_BITSANDBYTES and QUANTIZATION == "int8":
+        quantization_config = BitsAndBytesConfig(
+            load_in_8bit=True,
+            llm_int8_skip_modules=["vision_tower", "multi_modal_projector"],
+            llm_int8_enable_fp32_cpu_offload=True,
+        )
+
     model = LlavaForConditionalGeneration.from_pretrained(
-        MODEL_NAME,
+        model_name,
         torch_dtype=dtype,
-        device_map="cuda:0",
+        # Fills cuda:0 first and only spills trailing blocks to the CPU when
+        # the GPU is short on memory, instead of failing to load.
+        device_map="auto",
         low_cpu_mem_usage=True,
+        quantization_config=quantization_config,
+        attn_implementation=ATTN_IMPLEMENTATION,
     ).eval()
 
-    if progress_callback:
-        progress_callback(0, "complete", "JoyCaption model loaded successfully.")
+    # With a static KV cache every decode step has the same shapes, so the
+    # compiled forward is reused across steps. CUDA graphs ("reduce-overhead")
+    # are not used: layers offloaded by device_map="auto" break capture, and
+    # each new batch size would need a fresh capture.
+    model.forward = torch.compile(model.forward, fullgraph=False)
+
+    return processor, model
+
+
+def _get_model():
+    """Return the cached ``(processor, model)`` pair, loading it on first use."""
+    # Streamlit reruns can race on the first load; the lock keeps it single.
+    with _MODEL_LOCK:
+        return _load_model(MODEL_NAME)
 
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
+@functools.lru_cache(maxsize=256)
+def _render_prompt(prompt: str) -> str:
+    """Render the chat template for ``prompt``; repeated prompts hit the cache."""
+    processor, _ = _get_model()
 
     convo = [
         {"role": "system", "content": JOYCAPTION_PROMPT},
         {"role": "user", "content": prompt},
     ]
 
-    prompt_str = processor.apply_chat_template(
+    return processor.apply_chat_template(
         convo, tokenize=False, add_generation_prompt=True
     )
 
-    inputs = processor(text=[prompt_str], images=[image], return_tensors="pt").to("cuda:0")
 
-    if progress_callback:
-        progress_callback(1, "active", "Generating caption with JoyCaption...")
+def _ensure_worker() -> None:
+    """Start the caption worker thread if it is not running yet."""
+    global _worker
+    with _WORKER_LOCK:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(
+                target=_caption_worker, name="joycaption-batcher", daemon=True
+            )
+            _worker.start()
+
+
+def _caption_worker() -> None:
+    """Drain queued caption requests in small batches, forever."""
+    while True:
+        batch = [_CAPTION_REQUESTS.get()]
+        deadline = time.monotonic() + CAPTION_BATCH_WINDOW
+        while len(batch) < CAPTION_MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_CAPTION_REQUESTS.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            captions = _generate_batch(
+                [image for image, _, _, _ in batch],
+                [prompt_str for _, prompt_str, _, _ in batch],
+                [image_key for _, _, image_key, _ in batch],
+            )
+        except Exception as exc:  # surfaced to every waiting caller
+            for _, _, _, future in batch:
+                future.set_exception(exc)
+        else:
+            for (_, _, _, future), caption in zip(batch, captions):
+                future.set_result(caption)
+
+
+def _image_features(model, image_key: Optional[str], pixel_values):
+    """Return flattened projected features for one image, using the cache.
+
+    ``image_key`` of None bypasses the cache.
+    """
+    if image_key is not None and image_key in _IMAGE_FEATURES:
+        _IMAGE_FEATURES.move_to_end(image_key)
+        return _IMAGE_FEATURES[image_key]
+
+    features = model.get_image_features(
+        pixel_values=pixel_values,
+        vision_feature_layer=model.config.vision_feature_layer,
+        vision_feature_select_strategy=model.config.vision_feature_select_strategy,
+    )
+    if isinstance(features, (list, tuple)):
+        features = features[0]
+    features = features.reshape(-1, features.shape[-1])
+
+    if image_key is not None:
+        _IMAGE_FEATURES[image_key] = features
+        if len(_IMAGE_FEATURES) > IMAGE_FEATURE_CACHE_SIZE:
+            _IMAGE_FEATURES.popitem(last=False)
+    return features
+
+
+@functools.lru_cache(maxsize=1)
+def _outlines_tokenizer(tokenizer):
+    from outlines.models.transformers import TransformerTokenizer
+
+    return TransformerTokenizer(tokenizer)
+
 
-    with torch.no_grad():
+def _output_constraints(tokenizer):
+    """Return logits processors enforcing ``CAPTION_OUTPUT_PATTERN``, if any.
+
+    The processor tracks the state of each sequence, so a fresh one is made
+    per call; outlines caches the compiled automaton itself.
+    """
+    from transformers import LogitsProcessorList
+
+    if CAPTION_OUTPUT_PATTERN is None or not HAS_OUTLINES:
+        return LogitsProcessorList()
+
+    from outlines.processors import RegexLogitsProcessor
+
+    return LogitsProcessorList(
+        [RegexLogitsProcessor(CAPTION_OUTPUT_PATTERN, _outlines_tokenizer(tokenizer))]
+    )
+
+
+def _generate_batch(
+    images: List[Image.Image],
+    prompt_strs: List[str],
+    image_keys: List[Optional[str]],
+) -> List[str]:
+    """Run one ``generate`` call over a batch of images and rendered prompts."""
+    import torch
+
+    processor, model = _get_model()
+
+    # The image goes to the GPU as uint8 and is resized/normalized there,
+    # rather than shipping a float32 pixel tensor across from the CPU.
+    inputs = processor(
+        text=prompt_strs,
+        images=images,
+        padding=True,
+        return_tensors="pt",
+        images_kwargs={"device": "cuda:0"},
+    )
+
+    # Copy the remaining host tensors from pinned memory so the transfers run
+    # asynchronously; they are queued on the same stream as generate, so no
+    # explicit sync is needed.
+    inputs = {
+        name: tensor if tensor.is_cuda else tensor.pin_memory().to("cuda:0", non_blocking=True)
+        for name, tensor in inputs.items()
+    }
+    # Match the vision tower's dtype on the device rather than casting inside
+    # the first forward pass.
+    pixel_values = inputs.pop("pixel_values").to(torch.bfloat16)
+    input_ids = inputs["input_ids"]
+
+    with torch.inference_mode():
+        # Run the vision tower only for images not seen recently, then splice
+        # the features into the image token positions ourselves.
+        image_features = torch.cat(
+            [
+                _image_features(model, image_key, pixel_values[row : row + 1])
+                for row, image_key in enumerate(image_keys)
+            ]
+        )
+        inputs_embeds = model.get_input_embeddings()(input_ids)
+        image_mask = (input_ids == model.config.image_token_id).unsqueeze(-1)
+        inputs_embeds = inputs_embeds.masked_scatter(
+            image_mask.expand_as(inputs_embeds),
+            image_features.to(inputs_embeds.dtype),
+        )
+
+        # With inputs_embeds, generate returns only the new tokens
         gen_ids = model.generate(  
-            **inputs,
-            max_new_tokens=256,
-            do_sample=True,
-            temperature=0.6,
-            top_p=0.9,
+            inputs_embeds=inputs_embeds,
+            attention_mask=inputs["attention_mask"],
+            max_new_tokens=CAPTION_MAX_NEW_TOKENS,
+            stop_strings=CAPTION_STOP_STRINGS,
+            tokenizer=processor.tokenizer,
+            pad_token_id=processor.tokenizer.pad_token_id,
+            **_SAMPLING_KWARGS[SAMPLING_MODE],
             use_cache=True,
+            cache_implementation="static",
             suppress_tokens=None,
-        )[0]
+            logits_processor=_output_constraints(processor.tokenizer),
+        )
 
-    gen_ids = gen_ids[inputs["input_ids"].shape[1]:]
-    text = processor.tokenizer.decode(
+    texts = processor.tokenizer.batch_decode(
         gen_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
-    ).strip()
+    )
+    return [text.strip() for text in texts]
+
+
+def generate_caption(image_bytes: bytes, prompt: str, progress_callback) -> str:
+
+    if progress_callback:
+        progress_callback(0, "active", "Loading JoyCaption model...")
+
+    _get_model()
+
+    if progress_callback:
+        progress_callback(0, "complete", "JoyCaption model loaded successfully.")
+
+    image_key = hashlib.sha1(image_bytes).hexdigest()
+
+    # The vision tower works at 384px, so let the JPEG decoder downscale
+    # while decoding instead of materializing the full-resolution image.
+    # BytesIO shares the immutable ``bytes`` buffer, so this does not copy.
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("RGB", CAPTION_DECODE_SIZE)
+    # convert() always copies, even when the JPEG already decodes to RGB
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    prompt_str = _render_prompt(prompt)
+
+    if progress_callback:
+        progress_callback(1, "active", "Generating caption with JoyCaption...")
+
+    future: Future = Future()
+    _ensure_worker()
+    _CAPTION_REQUESTS.put((image, prompt_str, image_key, future))
+    text = future.result()
 
     if progress_callback:
         progress_callback(1, "complete", "Caption generation complete.")
 
     return text
 
+
+def warmup() -> None:
+    """Load JoyCaption and caption a placeholder image once.
+
+    This front-loads model loading and ``torch.compile`` so the first real
+    request does not pay for them.
+    """
+    _get_model()
+
+    future: Future = Future()
+    _ensure_worker()
+    _CAPTION_REQUESTS.put((Image.new("RGB", (64, 64)), _render_prompt("warm up"), None, future))
+    future.result()
+
+
+def caption_cache_version() -> Optional[str]:
+    """Return a tag identifying the settings that determine a caption.
+
+    Cached captions are only valid for the prompt template, model,
+    quantization, and decoding settings that produced them, so the tag is
+    hashed into every cache key. Returns None when sampling, since captions
+    are then not reproducible and should not be cached.
+    """
+    if SAMPLING_MODE != "greedy":
+        return None
+
+    settings = (
+        JOYCAPTION_PROMPT,
+        MODEL_NAME,
+        QUANTIZATION if HAS_BITSANDBYTES else "none",
+        SAMPLING_MODE,
+        str(CAPTION_MAX_NEW_TOKENS),
+        (CAPTION_OUTPUT_PATTERN or "") if HAS_OUTLINES else "",
+    )
+    return hashlib.sha256("\0".join(settings).encode("utf-8")).hexdigest()[:16]
+
+
+__all__ = ["caption_cache_version", "generate_caption", "warmup"]
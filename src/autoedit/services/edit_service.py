@@ -1,66 +1,532 @@
-"""Image editing stubs that fall back to lightweight behaviour for demos."""
+"""Image editing with the QWEN-Image-Edit diffusion pipeline."""
 
 from __future__ import annotations
 
+import functools
+import hashlib
+import importlib.util
 import io
-from datetime import datetime
-from pathlib import Path
-from typing import Optional
+import logging
+import math
+import os
+import secrets
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple
 
 from PIL import Image
 
-from typing import Optional
+from autoedit.services.prompts import QWEN_POSITIVE_PROMPT, QWEN_NEGATIVE_PROMPT
 
-import torch
-from diffusers import QwenImageEditPipeline
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = "ovedrive/qwen-image-edit-4bit"
+
+# Set QWEN_FP8=1 on Ada or Hopper GPUs to load the full model with FP8
+# (e4m3fn) transformer weights instead of the 4-bit checkpoint. FP8 linears
+# run on the FP8 tensor cores and move half the weight bytes of bf16.
+USE_FP8 = os.environ.get("QWEN_FP8") == "1"
+FP8_MODEL_PATH = "Qwen/Qwen-Image-Edit"
+# Left in bf16; quantizing the MLP output projections visibly hurts quality.
+FP8_EXCLUDED_MODULES = ["transformer_blocks.*.img_mlp.net.2"]
+HAS_MODELOPT = importlib.util.find_spec("modelopt") is not None
+# The FP8 transformer alone needs about 20 GB, and cpu offload moves all of it
+# onto the GPU for denoising, plus activations at ~1 MP. With less free VRAM
+# than this, stay on the NF4 checkpoint, whose weights remain 4-bit during
+# compute.
+FP8_MIN_FREE_MEMORY = 24 * 1024**3
+
+# Denoising steps per edit. The flow-matching scheduler holds up well at 10;
+# raise back to 20 for A/B quality comparisons.
+NUM_INFERENCE_STEPS = 10
+
+# Return cached CUDA blocks to the driver after an edit only when less than
+# this fraction of VRAM is free.
+EMPTY_CACHE_FREE_FRACTION = 0.1
+
+# First-block caching: when the first transformer block's output changes by
+# less than this relative amount between steps, reuse the cached residual of
+# the remaining blocks instead of running them. Set to None to disable.
+FIRST_BLOCK_CACHE_THRESHOLD: Optional[float] = 0.2
+
+# Approximate latent reuse: an edit of an upload whose prompt embedding is at
+# least this cosine-similar to a recent edit of the same upload starts from
+# that edit's latents after LATENT_REUSE_STEP steps instead of from noise,
+# skipping those steps. Off (None) by default because the reused trajectory
+# can carry traits of the earlier prompt into the new edit.
+LATENT_REUSE_THRESHOLD: Optional[float] = None
+LATENT_REUSE_STEP = 3
+LATENT_REUSE_CACHE_SIZE = 32
+
+# Encoding of the edited image. JPEG is encoded with nvJPEG straight from the
+# decoded tensor when torchvision is installed, and by Pillow otherwise. PNG
+# (at compress_level=1) and "WEBP" are also supported. The UI sniffs the
+# format from the bytes.
+OUTPUT_FORMAT = "JPEG"
+JPEG_QUALITY = 95
+
+HAS_TORCHVISION = importlib.util.find_spec("torchvision") is not None
+
+# Pixel area the pipeline resizes its input to before encoding it with the VAE.
+EDIT_TARGET_AREA = 1024 * 1024
+
+_ENCODE_OPTIONS = {
+    "JPEG": {"quality": JPEG_QUALITY},
+    "PNG": {"compress_level": 1, "optimize": False},
+    "WEBP": {"quality": 92, "method": 4},
+}
+
+# Encoding runs here so the calling thread can return to the GPU work
+_ENCODE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="autoedit-encode")
+
+# Loads the pipeline and encodes uploads while the caption is generated
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="autoedit-prefetch")
+
+# Qwen's attention processor already calls PyTorch SDPA; with flash-attn
+# installed, dispatch to its kernels instead.
+HAS_FLASH_ATTN = importlib.util.find_spec("flash_attn") is not None
+
+_PIPELINE_LOCK = threading.Lock()
+# Serializes calls into the loaded pipeline. Its offload hooks move models
+# on and off the GPU and assume a single caller at a time.
+_RUN_LOCK = threading.Lock()
+
+# VAE latents of recent uploads, so re-editing the same image with a new
+# prompt skips encoding it (and moving the VAE onto the GPU to do so).
+IMAGE_LATENT_CACHE_SIZE = 8
+_IMAGE_LATENTS: "OrderedDict[tuple, object]" = OrderedDict()
+# Hash of the upload the current thread is editing, read by the VAE wrapper
+_CURRENT_IMAGE = threading.local()
+
+# Embeddings of QWEN_NEGATIVE_PROMPT per upload. Qwen encodes prompts
+# together with the image, so the fixed negative prompt still has to be
+# encoded once per upload, but never again for later edits of it.
+NEGATIVE_EMBEDS_CACHE_SIZE = 8
+_NEGATIVE_EMBEDS: "OrderedDict[str, tuple]" = OrderedDict()
+
+# (image key, step count, prompt embedding, latents after LATENT_REUSE_STEP)
+_REUSABLE_LATENTS: "deque[tuple]" = deque(maxlen=LATENT_REUSE_CACHE_SIZE)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_pipeline(model_path: str):
+    # Imported lazily so importing this module does not initialize torch
+    import torch
+    from diffusers import QwenImageEditPipeline
+
+    components = {}
+    if model_path == FP8_MODEL_PATH:
+        components["transformer"] = _load_fp8_transformer(model_path)
+
+    pipeline = QwenImageEditPipeline.from_pretrained(
+        model_path, torch_dtype=torch.bfloat16, **components
+    )
+    pipeline.set_progress_bar_config(disable=None)
+    pipeline._encode_vae_image = _cache_vae_latents(pipeline._encode_vae_image)
+
+    if HAS_FLASH_ATTN:
+        pipeline.transformer.set_attention_backend("flash")
+
+    # Decode latents in tiles and one image at a time to cap peak VRAM
+    pipeline.vae.enable_tiling()
+    pipeline.vae.enable_slicing()
+
+    # The Qwen VAE is built from 3D convolutions; NDHWC weights let cuDNN use
+    # its tensor-core kernels, and benchmark mode picks them per tile shape.
+    pipeline.vae.to(memory_format=torch.channels_last_3d)
+    torch.backends.cudnn.benchmark = True
+
+    # Both checkpoints already store the transformer quantized. Store the VAE
+    # weights in FP8 as well and upcast each layer to bf16 just before it runs.
+    if torch.cuda.get_device_capability() >= (8, 9):
+        pipeline.vae.enable_layerwise_casting(
+            storage_dtype=torch.float8_e4m3fn, compute_dtype=torch.bfloat16
+        )
+
+    if FIRST_BLOCK_CACHE_THRESHOLD is not None:
+        from diffusers.hooks import FirstBlockCacheConfig
+
+        pipeline.transformer.enable_cache(
+            FirstBlockCacheConfig(threshold=FIRST_BLOCK_CACHE_THRESHOLD)
+        )
+
+    # Compile the denoiser once; every step of every later edit reuses the
+    # fused kernels. Inductor caches them on disk across process restarts.
+    # Compiling in place keeps the module type, so offload hooks still attach.
+    pipeline.transformer.compile(mode="max-autotune-no-cudagraphs", fullgraph=False)
+
+    # Move each component onto the GPU only while it runs instead of shuttling
+    # the whole pipeline between devices around every edit.
+    pipeline.enable_model_cpu_offload(gpu_id=0)
+
+    return pipeline
+
+
+def _cache_vae_latents(encode):
+    """Wrap the pipeline's VAE encode with the ``_IMAGE_LATENTS`` cache.
+
+    The pipeline encodes the conditioning image with the distribution mode
+    rather than a sample, so the latents of an upload never change.
+    """
+
+    @functools.wraps(encode)
+    def encode_cached(image, generator):
+        image_key = getattr(_CURRENT_IMAGE, "key", None)
+        if image_key is None:
+            return encode(image=image, generator=generator)
+
+        cache_key = (image_key, tuple(image.shape))
+        if cache_key in _IMAGE_LATENTS:
+            _IMAGE_LATENTS.move_to_end(cache_key)
+            return _IMAGE_LATENTS[cache_key]
+
+        latents = encode(image=image, generator=generator)
+        _IMAGE_LATENTS[cache_key] = latents
+        if len(_IMAGE_LATENTS) > IMAGE_LATENT_CACHE_SIZE:
+            _IMAGE_LATENTS.popitem(last=False)
+        return latents
+
+    return encode_cached
+
+
+def _load_fp8_transformer(model_path: str):
+    """Load the denoiser with FP8 weights; norms and activations stay bf16."""
+    import torch
+    from diffusers import NVIDIAModelOptConfig, QwenImageTransformer2DModel
+
+    quantization_config = NVIDIAModelOptConfig(
+        quant_type="FP8", modules_to_not_convert=FP8_EXCLUDED_MODULES
+    )
+    return QwenImageTransformer2DModel.from_pretrained(
+        model_path,
+        subfolder="transformer",
+        quantization_config=quantization_config,
+        torch_dtype=torch.bfloat16,
+    )
+
+
+def _use_fp8() -> bool:
+    """Whether the FP8 model was requested and this GPU can hold and run it."""
+    if not (USE_FP8 and HAS_MODELOPT):
+        return False
+    import torch
+
+    if torch.cuda.get_device_capability() < (8, 9):
+        return False
+    free_memory, _ = torch.cuda.mem_get_info()
+    return free_memory >= FP8_MIN_FREE_MEMORY
+
+
+@functools.lru_cache(maxsize=1)
+def select_model() -> str:
+    """Return the checkpoint the edit pipeline loads, probing the GPU once.
+
+    The choice depends on free VRAM, so it is made once per process: free
+    memory drops as models load, and re-probing later would select and load
+    the 4-bit pipeline alongside the FP8 one. Call this before loading any
+    other model so the probe sees an idle GPU.
+    """
+    return FP8_MODEL_PATH if _use_fp8() else MODEL_PATH
+
+
+def _get_pipeline():
+    """Return the cached edit pipeline, loading it on first use."""
+    with _PIPELINE_LOCK:
+        return _load_pipeline(select_model())
 
-from autoedit.services.prompts import QWEN_POSITIVE_PROMPT, QWEN_NEGATIVE_PROMPT
 
+def edit_image(
+    image_bytes: bytes,
+    refined_prompt: str,
+    progress_callback,
+    num_inference_steps: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> Tuple[Optional[bytes], int]:
+    encoded_image, seed = edit_image_async(
+        image_bytes, refined_prompt, progress_callback, num_inference_steps, seed
+    )
+    return encoded_image.result(), seed
 
-MODEL_PATH = "dimitribarbot/Qwen-Image-Edit-int8wo"
 
-def edit_image(image_bytes: bytes, refined_prompt: str, progress_callback) -> Optional[bytes]:
+def edit_image_async(
+    image_bytes: bytes,
+    refined_prompt: str,
+    progress_callback,
+    num_inference_steps: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> Tuple[Future, int]:
+    """Run the edit and return a Future for the encoded output bytes.
+
+    The denoising runs in the calling thread; only CPU image encoding is
+    left pending on the returned Future. ``num_inference_steps`` defaults to
+    ``NUM_INFERENCE_STEPS``. Without ``seed`` each call draws fresh noise;
+    the seed used is returned alongside the Future so the edit can be
+    reproduced by passing it back.
+    """
+    import torch
 
     if progress_callback:
         progress_callback(2, "active", "Loading QWEN-Image-Edit model...")
-    
-    model_path = "ovedrive/qwen-image-edit-4bit"
-    pipeline = QwenImageEditPipeline.from_pretrained(model_path, torch_dtype=torch.bfloat16)
-    pipeline.set_progress_bar_config(disable=None)
-    pipeline.to("cuda")
+
+    pipeline = _get_pipeline()
 
     if progress_callback:
         progress_callback(2, "complete", "QWEN-Image-Edit model loaded successfully.")
 
 
-    image = Image.open(io.BytesIO(image_bytes))
+    image = _decode_input(image_bytes)
+
+    if seed is None:
+        seed = secrets.randbits(63)
 
     prompt = refined_prompt + ". mantain the character face, eyes, skin details, lightning, pose, position and overall composition)"
     inputs = {
         "image": image,
         "prompt": prompt + ", " + QWEN_POSITIVE_PROMPT,
-        "generator": torch.manual_seed(0),
+        # Draw the initial noise directly on the device that denoises it
+        "generator": torch.Generator(device=pipeline._execution_device).manual_seed(seed),
         "true_cfg_scale": 4.0,
-        "negative_prompt": QWEN_NEGATIVE_PROMPT,
-        "num_inference_steps": 20, # even 10 steps should be enough in many cases
+        "num_inference_steps": num_inference_steps or NUM_INFERENCE_STEPS,
     }
 
+    encode_on_gpu = OUTPUT_FORMAT == "JPEG" and HAS_TORCHVISION
+    if encode_on_gpu:
+        # Keep the decoded image as a tensor on the GPU for nvJPEG
+        inputs["output_type"] = "pt"
+
     if progress_callback:
         progress_callback(3, "active", "Applying QWEN-Image-Edit...")
 
-    with torch.inference_mode():
-        output = pipeline(**inputs)
+    image_key = hashlib.sha1(image_bytes).hexdigest()
+    _CURRENT_IMAGE.key = image_key
+    try:
+        with _RUN_LOCK, torch.inference_mode():
+            negative_embeds, negative_mask = _negative_prompt_embeds(pipeline, image_key, image)
+            inputs["negative_prompt_embeds"] = negative_embeds
+            inputs["negative_prompt_embeds_mask"] = negative_mask
+            if LATENT_REUSE_THRESHOLD is not None:
+                _reuse_latents(pipeline, image_key, inputs)
+            output = pipeline(**inputs)
+    finally:
+        _CURRENT_IMAGE.key = None
 
-    pipeline.to("cpu")
-    torch.cuda.empty_cache()
+    # Keep the allocator's cached blocks for the next edit unless the GPU
+    # is actually running short. Query the device the pipeline ran on rather
+    # than whichever device is current on this thread.
+    free_memory, total_memory = torch.cuda.mem_get_info(pipeline._execution_device)
+    if free_memory < total_memory * EMPTY_CACHE_FREE_FRACTION:
+        torch.cuda.empty_cache()
 
     output_image = output.images[0]
-    
-    buffer = io.BytesIO()
-    output_image.save(buffer, format="PNG")
-    buffer.seek(0)
+    encoded_image = None
+    if encode_on_gpu:
+        try:
+            jpeg_bytes = _encode_jpeg_on_gpu(output_image)
+        except Exception as exc:  # pragma: no cover - depends on torchvision build
+            # torchvision releases before 0.19 cannot encode CUDA tensors
+            logger.warning("GPU JPEG encoding failed, falling back to PIL: %s", exc)
+            output_image = _tensor_to_pil(output_image)
+        else:
+            encoded_image = Future()
+            encoded_image.set_result(jpeg_bytes)
+    if encoded_image is None:
+        encoded_image = _ENCODE_POOL.submit(_encode_output, output_image)
 
     if progress_callback:
         progress_callback(3, "complete", "QWEN-Image-Edit applied successfully.")
 
-    return buffer.getvalue()
\ No newline at end of file
+    return encoded_image, seed
+
+
+def _prompt_image(pipeline, image: Image.Image) -> Image.Image:
+    """Resize ``image`` as the pipeline does before encoding it."""
+    from diffusers.pipelines.qwenimage.pipeline_qwenimage_edit import calculate_dimensions
+
+    width, height, _ = calculate_dimensions(EDIT_TARGET_AREA, image.width / image.height)
+    return pipeline.image_processor.resize(image, height, width)
+
+
+def _negative_prompt_embeds(pipeline, image_key: str, image: Image.Image) -> tuple:
+    """Return the negative prompt's embeddings and mask for an upload."""
+    if image_key in _NEGATIVE_EMBEDS:
+        _NEGATIVE_EMBEDS.move_to_end(image_key)
+        return _NEGATIVE_EMBEDS[image_key]
+
+    embeds = pipeline.encode_prompt(
+        prompt=QWEN_NEGATIVE_PROMPT,
+        image=_prompt_image(pipeline, image),
+        device=pipeline._execution_device,
+    )
+    _NEGATIVE_EMBEDS[image_key] = embeds
+    if len(_NEGATIVE_EMBEDS) > NEGATIVE_EMBEDS_CACHE_SIZE:
+        _NEGATIVE_EMBEDS.popitem(last=False)
+    return embeds
+
+
+def _reuse_latents(pipeline, image_key: str, inputs: dict) -> None:
+    """Resume ``inputs`` from a similar earlier edit, or record this one.
+
+    The prompt is encoded up front and its embeddings are passed on, so the
+    pipeline does not encode it a second time.
+    """
+    import numpy as np
+    import torch
+
+    steps = inputs["num_inference_steps"]
+    if steps <= LATENT_REUSE_STEP:
+        return
+
+    prompt_embeds, prompt_embeds_mask = pipeline.encode_prompt(
+        prompt=inputs.pop("prompt"),
+        image=_prompt_image(pipeline, inputs["image"]),
+        device=pipeline._execution_device,
+    )
+    inputs["prompt_embeds"] = prompt_embeds
+    inputs["prompt_embeds_mask"] = prompt_embeds_mask
+
+    # The final token attends to the whole prompt, so it serves as a summary
+    embedding = torch.nn.functional.normalize(prompt_embeds[0, -1].float(), dim=0)
+
+    for cached_key, cached_steps, cached_embedding, latents in reversed(_REUSABLE_LATENTS):
+        if cached_key != image_key or cached_steps != steps:
+            continue
+        if float(embedding @ cached_embedding) >= LATENT_REUSE_THRESHOLD:
+            # Continue on the remaining part of the default schedule
+            sigmas = np.linspace(1.0, 1 / steps, steps)[LATENT_REUSE_STEP:]
+            inputs["latents"] = latents
+            inputs["sigmas"] = sigmas.tolist()
+            inputs["num_inference_steps"] = len(sigmas)
+            return
+
+    def remember_latents(pipe, step, timestep, callback_kwargs):
+        if step == LATENT_REUSE_STEP - 1:
+            latents = callback_kwargs["latents"].clone()
+            _REUSABLE_LATENTS.append((image_key, steps, embedding, latents))
+        return callback_kwargs
+
+    inputs["callback_on_step_end"] = remember_latents
+
+
+def prefetch(image_bytes: bytes) -> Future:
+    """Load the pipeline and encode ``image_bytes`` in the background.
+
+    The edit prompt depends on the caption, but the conditioning latents and
+    the negative prompt embeddings do not, so they can be computed while the
+    caption model runs. Both land in the caches the edit reads from. Wait
+    for the returned Future before editing so the two never use the pipeline
+    at once.
+    """
+    # Choose the checkpoint here, before the caption model can start loading
+    # in parallel, so the VRAM probe does not depend on thread timing.
+    select_model()
+    return _PREFETCH_POOL.submit(_prefetch_latents, image_bytes)
+
+
+def _prefetch_latents(image_bytes: bytes) -> None:
+    import torch
+
+    pipeline = _get_pipeline()
+    image = _decode_input(image_bytes)
+    image_key = hashlib.sha1(image_bytes).hexdigest()
+
+    # Same preprocessing as QwenImageEditPipeline.__call__, so the cache key
+    # (which includes the tensor shape) matches the one the edit looks up.
+    prompt_image = _prompt_image(pipeline, image)
+    pixels = pipeline.image_processor.preprocess(
+        prompt_image, prompt_image.height, prompt_image.width
+    ).unsqueeze(2)
+    # Cast on the host and copy from pinned memory, so the upload is a single
+    # DMA that does not block the caption work running on the GPU.
+    pixels = pixels.to(torch.bfloat16).pin_memory()
+    pixels = pixels.to(pipeline._execution_device, non_blocking=True)
+
+    _CURRENT_IMAGE.key = image_key
+    try:
+        with _RUN_LOCK:
+            try:
+                with torch.inference_mode():
+                    pipeline._encode_vae_image(image=pixels, generator=None)
+                    _negative_prompt_embeds(pipeline, image_key, image)
+            finally:
+                # Outside pipeline.__call__ nothing offloads the text encoder
+                # and VAE again, so they would stay on the GPU through the
+                # caption model's generate.
+                pipeline.maybe_free_model_hooks()
+    finally:
+        _CURRENT_IMAGE.key = None
+
+
+def warmup() -> None:
+    """Load the edit pipeline and run a short placeholder edit once.
+
+    This front-loads model loading, ``torch.compile`` and cuDNN autotuning
+    so the first real request does not pay for them. The pipeline resizes
+    inputs to its working resolution, so a tiny image exercises the same
+    kernel shapes as a real upload.
+    """
+    import torch
+
+    pipeline = _get_pipeline()
+    with _RUN_LOCK, torch.inference_mode():
+        pipeline(
+            image=Image.new("RGB", (64, 64)),
+            prompt="warm up",
+            negative_prompt=QWEN_NEGATIVE_PROMPT,
+            true_cfg_scale=4.0,
+            num_inference_steps=2,
+            generator=torch.Generator(device=pipeline._execution_device).manual_seed(0),
+        )
+
+
+def _decode_input(image_bytes: bytes) -> Image.Image:
+    """Decode the uploaded image no larger than the pipeline needs.
+
+    The pipeline resizes its input to about ``EDIT_TARGET_AREA`` pixels, so
+    for JPEGs the decoder can downscale by a power of two while decoding
+    instead of producing full-resolution pixels that are discarded anyway.
+    Other formats are box-reduced by an integer factor, which leaves the
+    pipeline's Lanczos resize working on less than twice its output size.
+    The aspect ratio is kept so the pipeline picks the same working size.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    aspect_ratio = image.width / image.height
+    target_width = math.ceil(math.sqrt(EDIT_TARGET_AREA * aspect_ratio))
+    target_height = math.ceil(target_width / aspect_ratio)
+    # ``draft`` never scales below the requested size and is a no-op for
+    # formats other than JPEG.
+    image.draft("RGB", (target_width, target_height))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    factor = min(image.width // target_width, image.height // target_height)
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+
+def _encode_jpeg_on_gpu(image) -> bytes:
+    """Encode a ``(3, H, W)`` tensor in ``[0, 1]`` as JPEG on its device."""
+    import torch
+    from torchvision.io import encode_jpeg
+
+    pixels = image.mul(255).round_().to(torch.uint8)
+    return encode_jpeg(pixels, quality=JPEG_QUALITY).cpu().numpy().tobytes()
+
+
+def _tensor_to_pil(image) -> Image.Image:
+    """Convert a ``(3, H, W)`` tensor in ``[0, 1]`` to a PIL image."""
+    import torch
+
+    pixels = image.mul(255).round_().to(torch.uint8).permute(1, 2, 0)
+    return Image.fromarray(pixels.cpu().numpy())
+
+
+def _encode_output(image: Image.Image) -> bytes:
+    """Encode the edited image in ``OUTPUT_FORMAT``."""
+    buffer = io.BytesIO()
+    image.save(buffer, format=OUTPUT_FORMAT, **_ENCODE_OPTIONS[OUTPUT_FORMAT])
+    return buffer.getvalue()
+
+
+__all__ = ["edit_image", "edit_image_async", "prefetch", "select_model", "warmup"]
@@ -9,18 +9,25 @@ Streamlit UI can already orchestrate a realistic multi-step pipeline.
 
 from __future__ import annotations
 
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Callable, List, Optional
+from typing import Callable, List, Optional, Tuple
 
-import torch
-
-from services.caption_service import generate_caption
+from services.caption_cache import CaptionCache
+from services.caption_service import caption_cache_version, generate_caption
+from services.caption_service import warmup as warmup_caption_model
 from services.edit_service import edit_image
+from services.edit_service import prefetch as prefetch_edit_input
+from services.edit_service import select_model as select_edit_model
+from services.edit_service import warmup as warmup_edit_model
 
 from services.prompts import JOYCAPTION_PROMPT
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class WorkflowStepResult:
@@ -41,6 +48,7 @@ class ProcessResult:
     final_image: Optional[bytes]
     steps: List[WorkflowStepResult]
     created_at: datetime
+    seed: Optional[int] = None
 
 
 class JoyCaptionModel:
@@ -49,21 +57,53 @@ class JoyCaptionModel:
     def generate_caption(self, image_bytes: bytes, prompt: str, progress_callback: Optional[ProgressCallback] = None) -> str:
         return generate_caption(image_bytes, prompt, progress_callback)
 
+    def warmup(self) -> None:
+        warmup_caption_model()
+
 
 class QwenImageEditor:
     """Stands in for the QWEN-Image-Edit model."""
 
-    def apply_edit(self, image_bytes: bytes, refined_prompt: str, progress_callback: Optional[ProgressCallback] = None) -> Optional[bytes]:
-        return edit_image(image_bytes, refined_prompt, progress_callback)
+    def apply_edit(
+        self,
+        image_bytes: bytes,
+        refined_prompt: str,
+        progress_callback: Optional[ProgressCallback] = None,
+        num_inference_steps: Optional[int] = None,
+        seed: Optional[int] = None,
+    ) -> Tuple[Optional[bytes], int]:
+        return edit_image(image_bytes, refined_prompt, progress_callback, num_inference_steps, seed)
+
+    def prefetch(self, image_bytes: bytes) -> Future:
+        return prefetch_edit_input(image_bytes)
+
+    def warmup(self) -> None:
+        warmup_edit_model()
 
 
 ProgressCallback = Callable[[int, str, str], None]
 
+# Matches StorageService's default output directory
+_DEFAULT_OUTPUT_DIR = Path(__file__).parent.parent.parent.parent / "output"
+
+# Results are written here so the UI gets them without waiting on disk I/O.
+# A single worker keeps saves in request order.
+_SAVE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="autoedit-storage")
+
+# Runs queued ``process_async`` requests. Two workers let one request caption
+# while the other edits; each model still serves one batch at a time.
+_PROCESS_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="autoedit-process")
+
 
 class ImageProcessor:
     """Encapsulates the multi-stage image processing workflow."""
 
-    def __init__(self, enable_storage: bool = True, output_dir: Optional[Path] = None) -> None:
+    def __init__(
+        self,
+        enable_storage: bool = True,
+        output_dir: Optional[Path] = None,
+        warmup_models: bool = False,
+    ) -> None:
         """Initialize the image processor.
 
         Parameters
@@ -74,17 +114,46 @@ class ImageProcessor:
         output_dir:
             Optional custom output directory for storage.
             If None, uses the default 'output' directory.
+        warmup_models:
+            Whether to load and warm up both models before returning (see
+            :meth:`warmup`). Defaults to False.
         """
         self._caption_model = JoyCaptionModel()
         self._image_editor = QwenImageEditor()
         self._enable_storage = enable_storage
         self._output_dir = output_dir
+        self._storage = None
+        # Captions are cached alongside stored results, and only when they
+        # are reproducible (greedy decoding)
+        self._caption_cache: Optional[CaptionCache] = None
+        caption_version = caption_cache_version()
+        if enable_storage and caption_version is not None:
+            cache_dir = output_dir if output_dir is not None else _DEFAULT_OUTPUT_DIR
+            self._caption_cache = CaptionCache(cache_dir / "caption_cache.jsonl", caption_version)
+
+        if warmup_models:
+            self.warmup()
+
+    def warmup(self) -> None:
+        """Load both models and run each once on placeholder inputs.
+
+        Call at startup so that model loading and kernel compilation happen
+        before the first user request rather than during it. The two models
+        load concurrently.
+        """
+        # Let the edit service probe free VRAM before either model loads
+        select_edit_model()
+        edit_warmup = _PROCESS_POOL.submit(self._image_editor.warmup)
+        self._caption_model.warmup()
+        edit_warmup.result()
 
     def process(
         self,
         prompt: str,
         image_bytes: bytes,
         progress_callback: Optional[ProgressCallback] = None,
+        num_inference_steps: Optional[int] = None,
+        seed: Optional[int] = None,
     ) -> ProcessResult:
         """Process the provided image according to the multi-step workflow.
 
@@ -98,6 +167,12 @@ class ImageProcessor:
             Optional callable used to report progress updates. The callback
             receives the step index, the new status (``"active"``,
             ``"complete"``, or ``"error"``), and a human-readable message.
+        num_inference_steps:
+            Optional number of denoising steps for the edit. Fewer steps are
+            proportionally faster; defaults to the edit service's setting.
+        seed:
+            Optional seed for the edit's initial noise. Pass the ``seed`` of
+            an earlier result to reproduce it; a fresh one is drawn if None.
 
         Returns
         -------
@@ -116,11 +191,24 @@ class ImageProcessor:
                 created_at=datetime.now(timezone.utc),
             )
 
-        refined_prompt = self._caption_model.generate_caption(image_bytes, prompt, progress_callback)
+        # Load the edit model and encode the upload while the caption runs
+        prefetched = self._image_editor.prefetch(image_bytes)
+
+        refined_prompt = self._cached_caption(image_bytes, prompt)
+        if refined_prompt is None:
+            refined_prompt = self._caption_model.generate_caption(image_bytes, prompt, progress_callback)
+            self._cache_caption(image_bytes, prompt, refined_prompt)
+        elif progress_callback:
+            progress_callback(0, "complete", "JoyCaption not needed for this image.")
+            progress_callback(1, "complete", "Reused the caption from an earlier run.")
 
         caption_summary = refined_prompt if len(refined_prompt) <= 160 else refined_prompt[:157] + '...'
 
-        final_image = self._image_editor.apply_edit(image_bytes, refined_prompt, progress_callback)
+        # Prefetch failures are ignored; the edit then encodes the image itself
+        wait([prefetched])
+        final_image, seed = self._image_editor.apply_edit(
+            image_bytes, refined_prompt, progress_callback, num_inference_steps, seed
+        )
 
         steps = [
             WorkflowStepResult(
@@ -141,7 +229,11 @@ class ImageProcessor:
             WorkflowStepResult(
                 name="Finalization",
                 status="complete",
-                detail="Results saved and ready for display.",
+                detail=(
+                    "Result ready for display; saving to storage in the background."
+                    if self._enable_storage
+                    else "Result ready for display."
+                ),
             ),
         ]
 
@@ -152,14 +244,53 @@ class ImageProcessor:
             final_image=final_image,
             steps=steps,
             created_at=datetime.now(timezone.utc),
+            seed=seed,
         )
 
         # Save result to persistent storage if enabled
         if self._enable_storage:
-            self._save_result(result)
+            _SAVE_POOL.submit(self._save_result, result)
 
         return result
 
+    def process_async(
+        self,
+        prompt: str,
+        image_bytes: bytes,
+        progress_callback: Optional[ProgressCallback] = None,
+        num_inference_steps: Optional[int] = None,
+        seed: Optional[int] = None,
+    ) -> Future:
+        """Queue :meth:`process` and return a Future for its result.
+
+        Use this to submit several requests at once. The caption and edit
+        stages of consecutive requests then overlap on the GPU instead of
+        each request waiting for the previous one to finish both.
+        """
+        return _PROCESS_POOL.submit(
+            self.process, prompt, image_bytes, progress_callback, num_inference_steps, seed
+        )
+
+    def _cached_caption(self, image_bytes: bytes, prompt: str) -> Optional[str]:
+        """Return a previously generated caption, or None if there is none."""
+        if self._caption_cache is None:
+            return None
+        try:
+            return self._caption_cache.get(image_bytes, prompt)
+        except (OSError, KeyError) as e:
+            # An unreadable cache only costs a caption run
+            logger.warning("Failed to read the caption cache: %s", e)
+            return None
+
+    def _cache_caption(self, image_bytes: bytes, prompt: str, caption: str) -> None:
+        """Remember ``caption`` for later runs on the same input."""
+        if self._caption_cache is None:
+            return
+        try:
+            self._caption_cache.put(image_bytes, prompt, caption)
+        except (OSError, KeyError) as e:
+            logger.warning("Failed to write the caption cache: %s", e)
+
     def _save_result(self, result: ProcessResult) -> None:
         """Save a processing result to persistent storage.
 
@@ -169,14 +300,17 @@ class ImageProcessor:
             The processing result to save.
         """
         try:
-            # Import here to avoid circular dependency
-            from services.storage_service import StorageService
-
-            storage = StorageService(output_dir=self._output_dir)
-            storage.save_result(result)
+            if self._storage is None:
+                # Import here to avoid circular dependency
+                from services.storage_service import StorageService
+
+                # Created on first save so that constructing a processor
+                # does not touch the filesystem
+                self._storage = StorageService(output_dir=self._output_dir)
+            self._storage.save_result(result)
         except Exception as e:
             # Log error but don't fail the pipeline
-            print(f"Warning: Failed to save result to storage: {e}")
+            logger.exception("Failed to save result to storage: %s", e)
 
 
 __all__ = [
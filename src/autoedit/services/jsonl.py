@@ -0,0 +1,112 @@
+"""Helpers for append-only JSON Lines files.
+
+Each record occupies exactly one line, so new records can be appended without
+rewriting the file and readers can stream records in either direction.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+try:  # pragma: no cover - optional fast serializer
+    import orjson
+except ModuleNotFoundError:  # pragma: no cover - falls back to stdlib json
+    orjson = None  # type: ignore[assignment]
+
+_READ_CHUNK_SIZE = 64 * 1024
+
+
+def _dumps(record: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(record)
+    return json.dumps(record, ensure_ascii=False).encode("utf-8")
+
+
+# orjson.JSONDecodeError subclasses ValueError, like json's
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+def append_record(path: Path, record: dict) -> Tuple[int, int]:
+    """Append ``record`` as a single line to ``path``.
+
+    Parameters
+    ----------
+    path:
+        The JSON Lines file to append to. Created if missing.
+    record:
+        The JSON-serializable record to append.
+
+    Returns
+    -------
+    tuple of int
+        The byte offset and byte length of the record (excluding the newline).
+    """
+    line = _dumps(record)
+    with open(path, "ab") as f:
+        offset = f.seek(0, os.SEEK_END)
+        f.write(line + b"\n")
+    return offset, len(line)
+
+
+def read_record(path: Path, offset: int, length: int) -> dict:
+    """Read the single record stored at ``offset`` in ``path``."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return _loads(f.read(length))
+
+
+def iter_records(path: Path) -> Iterator[Tuple[int, int, dict]]:
+    """Yield ``(offset, length, record)`` for each record, oldest first.
+
+    Lines that cannot be decoded are skipped.
+    """
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            stripped = line.rstrip(b"\n")
+            if stripped:
+                try:
+                    yield offset, len(stripped), _loads(stripped)
+                except ValueError:
+                    pass
+            offset += len(line)
+
+
+def iter_records_reversed(path: Path) -> Iterator[dict]:
+    """Yield each record newest first by reading ``path`` backwards in chunks.
+
+    Lines that cannot be decoded are skipped.
+    """
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        remainder = b""
+        while position > 0:
+            step = min(_READ_CHUNK_SIZE, position)
+            position -= step
+            f.seek(position)
+            lines = (f.read(step) + remainder).split(b"\n")
+            # The first piece may be the tail of a line that continues in the
+            # previous chunk, so hold it back until that chunk is read.
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                record = _decode_line(line)
+                if record is not None:
+                    yield record
+        record = _decode_line(remainder)
+        if record is not None:
+            yield record
+
+
+def _decode_line(line: bytes) -> Optional[dict]:
+    if not line.strip():
+        return None
+    try:
+        return _loads(line)
+    except ValueError:
+        return None
+
+
+__all__ = ["append_record", "iter_records", "iter_records_reversed", "read_record"]
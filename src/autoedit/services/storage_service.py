@@ -1,17 +1,97 @@
 """Storage service for persisting processing results.
 
 This module handles saving processing results to the output directory,
-including images, metadata, and a results index file.
+including images, metadata, and a results index file. Results are stored as
+an append-only JSON Lines log so that saving a result never rewrites the
+existing history.
 """
 
 from __future__ import annotations
 
+import functools
+import hashlib
+import io
 import json
+import os
+import re
+import tempfile
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-from services.image_processor import ProcessResult
+from PIL import Image
+
+from services.jsonl import append_record, iter_records, iter_records_reversed, read_record
+
+if TYPE_CHECKING:  # pragma: no cover - annotations only
+    # A runtime import would load image_processor a second time under the
+    # ``services`` name when it is already loaded as ``autoedit.services``.
+    from autoedit.services.image_processor import ProcessResult
+
+try:  # pragma: no cover - optional libjpeg-turbo bindings
+    from turbojpeg import TJPF_RGB, TurboJPEG
+except ModuleNotFoundError:  # pragma: no cover - Pillow encodes instead
+    TurboJPEG = None  # type: ignore[assignment]
+
+
+# A file's (st_mtime_ns, st_size). The size catches appends that land within
+# the filesystem's mtime resolution; the mtime catches same-size rewrites.
+_FileStamp = Tuple[int, int]
+
+# Parsed results keyed by results file, tagged with the file's stamp so that
+# repeated reads within one process only re-parse when the file has changed.
+_RESULTS_CACHE: Dict[Path, Tuple[_FileStamp, list]] = {}
+
+# Parsed indexes keyed by index file, tagged with the (index, results) file
+# stamps they describe. Appends through this service extend them in place.
+_INDEX_CACHE: Dict[Path, Tuple[Tuple[_FileStamp, _FileStamp], dict]] = {}
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+_JPEG_MAGIC = b"\xff\xd8\xff"
+_JPEG_QUALITY = 92
+
+
+def _file_stamp(path: Path) -> Optional[_FileStamp]:
+    """Return the stamp of ``path``, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _tokenize(text: str) -> List[str]:
+    """Split text into casefolded word tokens for the keyword index."""
+    return _TOKEN_PATTERN.findall(text.casefold())
+
+
+@functools.lru_cache(maxsize=1)
+def _turbojpeg():
+    return TurboJPEG()
+
+
+def _to_jpeg(image_bytes: bytes) -> bytes:
+    """Return ``image_bytes`` as JPEG, re-encoding other image formats.
+
+    JPEG input and bytes that cannot be decoded are returned unchanged.
+    """
+    if image_bytes.startswith(_JPEG_MAGIC):
+        return image_bytes
+    try:
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    except OSError:
+        return image_bytes
+
+    if TurboJPEG is not None:
+        import numpy as np
+
+        return _turbojpeg().encode(
+            np.asarray(image), quality=_JPEG_QUALITY, pixel_format=TJPF_RGB
+        )
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=_JPEG_QUALITY)
+    return buffer.getvalue()
 
 
 class StorageService:
@@ -33,10 +113,17 @@ class StorageService:
 
         self.output_dir = output_dir
         self.images_dir = output_dir / "images"
-        self.results_file = output_dir / "results.json"
+        # Image contents stored once under their SHA-256; images_dir holds
+        # hard links to these, one per result.
+        self.blobs_dir = output_dir / "blobs"
+        self.results_file = output_dir / "results.jsonl"
+        self.index_file = output_dir / "results.index.jsonl"
 
         # Ensure directories exist
         self.images_dir.mkdir(parents=True, exist_ok=True)
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+
+        self._migrate_legacy_results()
 
     def save_result(self, result: ProcessResult) -> dict:
         """Save a processing result to persistent storage.
@@ -57,11 +144,12 @@ class StorageService:
 
         # Save the final image if available
         image_filename = None
+        image_digest = None
         if result.final_image:
+            image_bytes = _to_jpeg(result.final_image)
+            image_digest = hashlib.sha256(image_bytes).hexdigest()
             image_filename = f"{result_id}.jpg"
-            image_path = self.images_dir / image_filename
-            with open(image_path, "wb") as f:
-                f.write(result.final_image)
+            self._link_image(image_bytes, image_digest, self.images_dir / image_filename)
 
         # Create result entry
         result_entry = {
@@ -71,6 +159,8 @@ class StorageService:
             "caption": result.caption,
             "refined_prompt": result.refined_prompt,
             "image_filename": image_filename,
+            "image_sha256": image_digest,
+            "seed": result.seed,
             "steps": [
                 {
                     "name": step.name,
@@ -81,16 +171,99 @@ class StorageService:
             ],
         }
 
-        # Load existing results
-        results = self._load_results()
+        self._append_result(result_entry)
 
-        # Add new result at the beginning
-        results.insert(0, result_entry)
+        return result_entry
 
-        # Save updated results
-        self._save_results(results)
+    def _link_image(self, image_bytes: bytes, digest: str, image_path: Path) -> None:
+        """Store ``image_bytes`` at ``image_path`` as a link to its blob.
 
-        return result_entry
+        Identical images share one blob, which is written only the first
+        time. Where hard links are unsupported the bytes are copied instead.
+        """
+        blob_path = self.blobs_dir / f"{digest}.jpg"
+        if not blob_path.exists():
+            # Write under a temporary name so the blob never appears partial
+            fd, tmp_name = tempfile.mkstemp(dir=self.blobs_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(image_bytes)
+            os.replace(tmp_name, blob_path)
+
+        try:
+            os.link(blob_path, image_path)
+        except OSError:
+            with open(image_path, "wb") as f:
+                f.write(image_bytes)
+
+    def _append_result(self, result_entry: dict) -> None:
+        """Append a result entry to the results log and the index.
+
+        Parameters
+        ----------
+        result_entry:
+            The result entry to append.
+        """
+        previous_stamp = _file_stamp(self.results_file)
+        previous_stamps = self._file_stamps()
+        index_current = self._index_is_current()
+
+        offset, length = append_record(self.results_file, result_entry)
+        if index_current:
+            index_entry = self._append_index_entry(result_entry, offset, length)
+
+            # Keep a warm in-memory index in step with the files
+            cached_index = _INDEX_CACHE.get(self.index_file)
+            if cached_index is not None and cached_index[0] == previous_stamps:
+                self._add_to_index(cached_index[1], index_entry)
+                _INDEX_CACHE[self.index_file] = (self._file_stamps(), cached_index[1])
+            else:
+                _INDEX_CACHE.pop(self.index_file, None)
+        else:
+            self.build_index()
+
+        # Extend the cache in place so the next read does not re-parse the log
+        cached = _RESULTS_CACHE.get(self.results_file)
+        if cached is not None and cached[0] == previous_stamp:
+            _RESULTS_CACHE[self.results_file] = (
+                _file_stamp(self.results_file),
+                [result_entry] + cached[1],
+            )
+        else:
+            _RESULTS_CACHE.pop(self.results_file, None)
+
+    def _file_stamps(self) -> Tuple[_FileStamp, _FileStamp]:
+        """Return the stamps of the index and results files ((0, 0) if missing)."""
+        return (
+            _file_stamp(self.index_file) or (0, 0),
+            _file_stamp(self.results_file) or (0, 0),
+        )
+
+    def _migrate_legacy_results(self) -> None:
+        """Convert a ``results.json`` array from older versions to the log."""
+        legacy_file = self.output_dir / "results.json"
+        if self.results_file.exists() or not legacy_file.exists():
+            return
+
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
+                legacy_results = json.load(f)
+        except (json.JSONDecodeError, IOError):
+            return
+
+        # Written aside and moved into place whole, so an interrupted
+        # migration leaves no results file and is retried on the next start
+        fd, tmp_name = tempfile.mkstemp(dir=self.output_dir, suffix=".tmp")
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        try:
+            # The legacy array is newest first; the log is appended oldest first
+            for entry in reversed(legacy_results):
+                append_record(tmp_path, entry)
+            os.replace(tmp_path, self.results_file)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        self.build_index()
+        legacy_file.replace(self.output_dir / "results.json.migrated")
 
     def _load_results(self) -> list:
         """Load existing results from the results file.
@@ -98,28 +271,115 @@ class StorageService:
         Returns
         -------
         list
-            List of result entries, or empty list if file doesn't exist.
+            List of result entries (newest first), or empty list if the
+            file doesn't exist.
         """
-        if not self.results_file.exists():
+        stamp = _file_stamp(self.results_file)
+        if stamp is None:
+            _RESULTS_CACHE.pop(self.results_file, None)
             return []
 
+        cached = _RESULTS_CACHE.get(self.results_file)
+        if cached is not None and cached[0] == stamp:
+            return list(cached[1])
+
         try:
-            with open(self.results_file, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            # If file is corrupted or unreadable, start fresh
+            results = list(iter_records_reversed(self.results_file))
+        except IOError:
             return []
 
-    def _save_results(self, results: list) -> None:
-        """Save results to the results file.
+        _RESULTS_CACHE[self.results_file] = (stamp, results)
+        return list(results)
+
+    def _append_index_entry(self, entry: dict, offset: int, length: int) -> dict:
+        """Append the index line describing one stored result.
 
         Parameters
         ----------
-        results:
-            List of result entries to save.
+        entry:
+            The result entry that was appended.
+        offset:
+            Byte offset of the entry within the results file.
+        length:
+            Byte length of the entry's line, excluding the newline.
+
+        Returns
+        -------
+        dict
+            The index line that was written.
+        """
+        tokens = list(dict.fromkeys(_tokenize(entry.get("user_prompt") or "")))
+        index_entry = {"id": entry["id"], "offset": offset, "length": length, "tokens": tokens}
+        append_record(self.index_file, index_entry)
+        return index_entry
+
+    @staticmethod
+    def _add_to_index(index: dict, index_entry: dict) -> None:
+        """Register one index line with an in-memory index."""
+        index["offsets"][index_entry["id"]] = [index_entry["offset"], index_entry["length"]]
+        for token in index_entry["tokens"]:
+            index["tokens"].setdefault(token, set()).add(index_entry["id"])
+
+    def _index_is_current(self) -> bool:
+        """Check whether the last index line ends where the results file ends."""
+        try:
+            results_size = os.stat(self.results_file).st_size
+        except OSError:
+            results_size = 0
+
+        try:
+            last_entry = next(iter_records_reversed(self.index_file), None)
+        except OSError:
+            last_entry = None
+
+        indexed_end = 0
+        if last_entry is not None:
+            indexed_end = last_entry["offset"] + last_entry["length"] + 1
+        return indexed_end == results_size
+
+    def _load_index(self) -> Optional[dict]:
+        """Load the index if it covers the whole results file.
+
+        Returns
+        -------
+        dict or None
+            A dict with ``offsets`` (id to ``[offset, length]``) and
+            ``tokens`` (word to set of ids), or None if the index is missing
+            or does not match the results file.
+        """
+        stamps = self._file_stamps()
+        cached = _INDEX_CACHE.get(self.index_file)
+        if cached is not None and cached[0] == stamps:
+            return cached[1]
+
+        try:
+            index_entries = [record for _, _, record in iter_records(self.index_file)]
+        except OSError:
+            return None
+
+        index: dict = {"offsets": {}, "tokens": {}}
+        indexed_end = 0
+        for entry in index_entries:
+            self._add_to_index(index, entry)
+            indexed_end = max(indexed_end, entry["offset"] + entry["length"] + 1)
+
+        if indexed_end != stamps[1][1]:
+            return None
+
+        _INDEX_CACHE[self.index_file] = (stamps, index)
+        return index
+
+    def build_index(self) -> None:
+        """Rebuild the results index from the current results file.
+
+        Useful for results files modified outside of this service.
         """
-        with open(self.results_file, "w", encoding="utf-8") as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        _INDEX_CACHE.pop(self.index_file, None)
+        self.index_file.unlink(missing_ok=True)
+        if not self.results_file.exists():
+            return
+        for offset, length, entry in iter_records(self.results_file):
+            self._append_index_entry(entry, offset, length)
 
     def get_all_results(self) -> list:
         """Retrieve all stored results.
@@ -127,7 +387,7 @@ class StorageService:
         Returns
         -------
         list
-            List of all result entries.
+            List of all result entries, newest first.
         """
         return self._load_results()
 
@@ -144,12 +404,54 @@ class StorageService:
         dict or None
             The result entry if found, None otherwise.
         """
+        index = self._load_index()
+        if index is not None:
+            span = index["offsets"].get(result_id)
+            if span is None:
+                return None
+            try:
+                entry = read_record(self.results_file, *span)
+                if entry.get("id") == result_id:
+                    return entry
+            except (ValueError, OSError):
+                pass
+
         results = self._load_results()
         for result in results:
             if result["id"] == result_id:
                 return result
         return None
 
+    def find_results_by_keyword(self, keyword: str) -> list:
+        """Retrieve results whose user prompt contains every word of ``keyword``.
+
+        Parameters
+        ----------
+        keyword:
+            One or more words to look for. Matching is case-insensitive and
+            on whole words.
+
+        Returns
+        -------
+        list
+            Matching result entries, newest first.
+        """
+        tokens = _tokenize(keyword)
+        if not tokens:
+            return []
+
+        index = self._load_index()
+        if index is None:
+            self.build_index()
+            index = self._load_index() or {"offsets": {}, "tokens": {}}
+
+        postings = [index["tokens"].get(token, set()) for token in tokens]
+        matching_ids = set.intersection(*postings)
+
+        # Later offsets are newer entries, so read matches back to front
+        spans = sorted((index["offsets"][result_id] for result_id in matching_ids), reverse=True)
+        return [read_record(self.results_file, *span) for span in spans]
+
     def get_image_path(self, image_filename: str) -> Path:
         """Get the full path to a saved image.
 
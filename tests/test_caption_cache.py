@@ -0,0 +1,56 @@
+"""Tests for the caption cache."""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+from autoedit.services import caption_service
+from autoedit.services.caption_cache import CaptionCache, caption_key
+
+
+def test_caption_cache_round_trip(tmp_path: Path):
+    """Test that captions are returned only for the exact image and prompt."""
+    cache = CaptionCache(tmp_path / "cache" / "captions.jsonl")
+
+    assert cache.get(b"image", "brighten") is None
+
+    cache.put(b"image", "brighten", "A brighter photo.")
+
+    assert cache.get(b"image", "brighten") == "A brighter photo."
+    assert cache.get(b"image", "darken") is None
+    assert cache.get(b"other", "brighten") is None
+
+
+def test_caption_cache_persists_across_instances(tmp_path: Path):
+    """Test that captions survive reloading and the newest entry wins."""
+    cache_file = tmp_path / "captions.jsonl"
+    CaptionCache(cache_file).put(b"image", "brighten", "First.")
+    CaptionCache(cache_file).put(b"image", "brighten", "Second.")
+
+    assert CaptionCache(cache_file).get(b"image", "brighten") == "Second."
+
+
+def test_caption_key_separates_image_and_prompt():
+    """Test that moving bytes between image and prompt changes the key."""
+    assert caption_key(b"ab", "c") != caption_key(b"a", "bc")
+
+
+def test_caption_cache_ignores_entries_from_other_settings(tmp_path: Path):
+    """Test that entries written under another settings version are skipped."""
+    cache_file = tmp_path / "captions.jsonl"
+    CaptionCache(cache_file, version="v1").put(b"image", "brighten", "Old.")
+
+    assert CaptionCache(cache_file, version="v2").get(b"image", "brighten") is None
+    assert CaptionCache(cache_file, version="v1").get(b"image", "brighten") == "Old."
+
+
+def test_caption_cache_version_disabled_when_sampling(monkeypatch):
+    """Test that sampled captions are not cached and settings change the tag."""
+    greedy_version = caption_service.caption_cache_version()
+    assert greedy_version is not None
+
+    monkeypatch.setattr(caption_service, "CAPTION_MAX_NEW_TOKENS", 32)
+    assert caption_service.caption_cache_version() != greedy_version
+
+    monkeypatch.setattr(caption_service, "SAMPLING_MODE", "sample")
+    assert caption_service.caption_cache_version() is None
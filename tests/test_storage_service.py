@@ -2,15 +2,18 @@
 
 from __future__ import annotations
 
+import io
 import json
+import os
 import tempfile
 from datetime import datetime, timezone
 from pathlib import Path
 
 import pytest
+from PIL import Image
 
 from autoedit.services.image_processor import ProcessResult, WorkflowStepResult
-from autoedit.services.storage_service import StorageService
+from autoedit.services.storage_service import _RESULTS_CACHE, StorageService
 
 
 def test_storage_service_initialization():
@@ -21,7 +24,7 @@ def test_storage_service_initialization():
 
         assert storage.output_dir == output_dir
         assert storage.images_dir == output_dir / "images"
-        assert storage.results_file == output_dir / "results.json"
+        assert storage.results_file == output_dir / "results.jsonl"
         assert storage.images_dir.exists()
 
 
@@ -62,10 +65,78 @@ def test_save_result_with_image():
         assert image_path.exists()
         assert image_path.read_bytes() == b"fake image data"
 
-        # Check that results.json was created
+        # Check that results.jsonl was created
         assert storage.results_file.exists()
 
 
+def test_save_result_records_seed():
+    """Test that the edit seed is stored so the edit can be reproduced."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = StorageService(output_dir=Path(tmpdir))
+
+        result = ProcessResult(
+            user_prompt="Test prompt",
+            caption="Test caption",
+            refined_prompt="Test refined prompt",
+            final_image=b"fake image data",
+            steps=[],
+            created_at=datetime.now(timezone.utc),
+            seed=1234,
+        )
+        storage.save_result(result)
+
+        assert storage.get_all_results()[0]["seed"] == 1234
+
+
+def test_save_result_stores_png_as_jpeg():
+    """Test that non-JPEG images are re-encoded to match the .jpg filename."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = StorageService(output_dir=Path(tmpdir))
+
+        png_buffer = io.BytesIO()
+        Image.new("RGB", (16, 16), "red").save(png_buffer, format="PNG")
+
+        result = ProcessResult(
+            user_prompt="Test prompt",
+            caption="Test caption",
+            refined_prompt="Test refined prompt",
+            final_image=png_buffer.getvalue(),
+            steps=[],
+            created_at=datetime.now(timezone.utc),
+        )
+
+        saved_entry = storage.save_result(result)
+
+        image_path = storage.images_dir / saved_entry["image_filename"]
+        with Image.open(image_path) as stored:
+            assert stored.format == "JPEG"
+            assert stored.size == (16, 16)
+
+
+def test_identical_images_share_one_blob():
+    """Test that results with identical images are stored only once."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = StorageService(output_dir=Path(tmpdir))
+
+        entries = []
+        for i in range(2):
+            result = ProcessResult(
+                user_prompt=f"Prompt {i}",
+                caption="Caption",
+                refined_prompt="Refined",
+                final_image=b"same image data",
+                steps=[],
+                created_at=datetime(2025, 1, 1, 12, 0, i, tzinfo=timezone.utc),
+            )
+            entries.append(storage.save_result(result))
+
+        assert entries[0]["image_sha256"] == entries[1]["image_sha256"]
+        assert len(list(storage.blobs_dir.iterdir())) == 1
+        for entry in entries:
+            image_path = storage.get_image_path(entry["image_filename"])
+            assert image_path.read_bytes() == b"same image data"
+
+
 def test_save_result_without_image():
     """Test saving a processing result without an image."""
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -88,7 +159,7 @@ def test_save_result_without_image():
         # Check that no image filename is set
         assert saved_entry["image_filename"] is None
 
-        # Check that results.json was still created
+        # Check that results.jsonl was still created
         assert storage.results_file.exists()
 
 
@@ -161,8 +232,8 @@ def test_get_image_path():
         assert image_path == storage.images_dir / image_filename
 
 
-def test_results_json_format():
-    """Test that the results.json file is properly formatted."""
+def test_results_jsonl_format():
+    """Test that the results.jsonl file is properly formatted."""
     with tempfile.TemporaryDirectory() as tmpdir:
         output_dir = Path(tmpdir)
         storage = StorageService(output_dir=output_dir)
@@ -189,14 +260,13 @@ def test_results_json_format():
         )
         storage.save_result(result)
 
-        # Load the JSON file directly
+        # Load the JSON Lines file directly
         with open(storage.results_file, "r", encoding="utf-8") as f:
-            data = json.load(f)
+            data = [json.loads(line) for line in f]
 
         # Check structure
-        assert isinstance(data, list)
         assert len(data) == 1
-        
+
         entry = data[0]
         assert "id" in entry
         assert "timestamp" in entry
@@ -210,3 +280,147 @@ def test_results_json_format():
 
         # Check unicode is preserved
         assert entry["caption"] == "Test caption with unicode: 你好"
+
+
+def test_get_all_results_reloads_after_external_change():
+    """Test that cached results are refreshed when the file changes on disk."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_dir = Path(tmpdir)
+        storage = StorageService(output_dir=output_dir)
+
+        result = ProcessResult(
+            user_prompt="Test prompt",
+            caption="Test caption",
+            refined_prompt="Test refined prompt",
+            final_image=None,
+            steps=[],
+            created_at=datetime.now(timezone.utc),
+        )
+        storage.save_result(result)
+        assert len(storage.get_all_results()) == 1
+
+        # Mutating the returned list must not leak into the cache
+        storage.get_all_results().clear()
+        assert len(storage.get_all_results()) == 1
+
+        # Simulate another process rewriting the file
+        storage.results_file.write_text("", encoding="utf-8")
+        os.utime(storage.results_file, ns=(0, 0))
+
+        assert StorageService(output_dir=output_dir).get_all_results() == []
+
+
+def test_find_results_by_keyword_uses_index():
+    """Test keyword lookup and id lookup through the results index."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_dir = Path(tmpdir)
+        storage = StorageService(output_dir=output_dir)
+
+        prompts = ["Make it dramatic", "Add a dramatic sky", "Soft pastel look"]
+        saved = []
+        for i, prompt in enumerate(prompts):
+            result = ProcessResult(
+                user_prompt=prompt,
+                caption=f"Test caption {i}",
+                refined_prompt=f"Test refined prompt {i}",
+                final_image=None,
+                steps=[],
+                created_at=datetime(2025, 1, 1, 12, 0, i, tzinfo=timezone.utc),
+            )
+            saved.append(storage.save_result(result))
+
+        assert storage.index_file.exists()
+
+        matches = storage.find_results_by_keyword("DRAMATIC")
+        assert [r["user_prompt"] for r in matches] == ["Add a dramatic sky", "Make it dramatic"]
+        assert [r["user_prompt"] for r in storage.find_results_by_keyword("dramatic sky")] == [
+            "Add a dramatic sky"
+        ]
+        assert storage.find_results_by_keyword("vintage") == []
+
+        for entry in saved:
+            assert storage.get_result_by_id(entry["id"]) == entry
+
+        # Appends after a query keep the in-memory index in step
+        storage.save_result(
+            ProcessResult(
+                user_prompt="Dramatic Straße at night",
+                caption="",
+                refined_prompt="",
+                final_image=None,
+                steps=[],
+                created_at=datetime(2025, 1, 1, 12, 0, 9, tzinfo=timezone.utc),
+            )
+        )
+        assert len(storage.find_results_by_keyword("dramatic")) == 3
+        assert [r["user_prompt"] for r in storage.find_results_by_keyword("STRASSE")] == [
+            "Dramatic Straße at night"
+        ]
+
+
+def test_append_preserves_existing_lines():
+    """Test that saving a result appends instead of rewriting the log."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_dir = Path(tmpdir)
+        storage = StorageService(output_dir=output_dir)
+
+        for i in range(2):
+            result = ProcessResult(
+                user_prompt=f"Test prompt {i}",
+                caption=f"Test caption {i}",
+                refined_prompt=f"Test refined prompt {i}",
+                final_image=None,
+                steps=[],
+                created_at=datetime(2025, 1, 1, 12, 0, i, tzinfo=timezone.utc),
+            )
+            before = storage.results_file.read_bytes() if storage.results_file.exists() else b""
+            storage.save_result(result)
+            assert storage.results_file.read_bytes().startswith(before)
+
+        # A fresh service (no in-process cache) still reads newest first
+        _RESULTS_CACHE.clear()
+        results = StorageService(output_dir=output_dir).get_all_results()
+        assert [r["user_prompt"] for r in results] == ["Test prompt 1", "Test prompt 0"]
+
+
+def test_legacy_results_json_is_migrated():
+    """Test that a results.json array from older versions is converted."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_dir = Path(tmpdir)
+        legacy = [
+            {"id": "result_b", "user_prompt": "newer", "steps": []},
+            {"id": "result_a", "user_prompt": "older", "steps": []},
+        ]
+        (output_dir / "results.json").write_text(json.dumps(legacy), encoding="utf-8")
+
+        storage = StorageService(output_dir=output_dir)
+
+        assert storage.get_all_results() == legacy
+        assert storage.get_result_by_id("result_a") == legacy[1]
+        assert not (output_dir / "results.json").exists()
+        assert not list(output_dir.glob("*.tmp"))
+
+
+def test_cached_results_notice_appends_with_unchanged_mtime():
+    """Test that an append within the mtime resolution is not served stale."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = StorageService(output_dir=Path(tmpdir))
+        storage.save_result(
+            ProcessResult(
+                user_prompt="first",
+                caption="",
+                refined_prompt="",
+                final_image=None,
+                steps=[],
+                created_at=datetime(2025, 1, 1, 12, 0, 0, tzinfo=timezone.utc),
+            )
+        )
+        assert len(storage.get_all_results()) == 1
+
+        # Another writer appends without the mtime moving
+        stat = os.stat(storage.results_file)
+        with open(storage.results_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": "result_external", "steps": []}) + "\n")
+        os.utime(storage.results_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        assert storage.get_all_results()[0]["id"] == "result_external"